@@ -1,122 +1,384 @@
 import os
+import shlex
+import stat
 import subprocess
 import sys
+import tarfile
+import time
+import zipfile
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import suppress
 
+SUPPORTED_FORMATS = ("zip", "tar", "tgz", "tbz2")
+SUPPORTED_FORMAT_SET = frozenset(SUPPORTED_FORMATS)
+# 6 is gzip's own default: much faster than 9 for a marginally larger archive.
+# Overridable through the compressLevel input.
+COMPRESS_LEVEL_INPUT = os.getenv("COMPRESSLEVEL") or "6"
+try:
+    COMPRESS_LEVEL = int(COMPRESS_LEVEL_INPUT)
+except ValueError:
+    COMPRESS_LEVEL = None  # Rejected in __main__ before anything is compressed
+EXTENSIONS = {format: f".{format}" for format in SUPPORTED_FORMATS}
+# Fixed for the lifetime of an action run, so resolve it (and the getcwd()
+# fallback, only taken when the variable is unset or empty) once.
+WORKSPACE = os.getenv("GITHUB_WORKSPACE") or os.getcwd()
+# GitHub sets RUNNER_DEBUG=1 when a run is re-run with debug logging enabled.
+VERBOSE = os.getenv("RUNNER_DEBUG") == "1"
+# Only have tar list every file when debugging.
+TAR_VERBOSE = ["-v"] if VERBOSE else []
 
-def run_command(command):
-    print(f"Executing command: {command}")
-    result = subprocess.run(command, shell=True, text=True, capture_output=True)
-    if result.stdout:
-        print(f"Command output: {result.stdout.strip()}")
-    if result.stderr:
-        print(f"Command errors: {result.stderr.strip()}")
 
+def run_command(argv, verbose=VERBOSE):
+    print(f"Executing command: {shlex.join(argv)}")
+    # Per-file listings from tar go to stdout; only keep them when
+    # debugging. Whatever is kept is streamed line by line rather than
+    # buffered, and stderr is folded into the same pipe so one reader suffices.
+    with subprocess.Popen(
+        argv,
+        text=True,
+        stdout=subprocess.PIPE if verbose else subprocess.DEVNULL,
+        stderr=subprocess.STDOUT if verbose else subprocess.PIPE,
+    ) as process:
+        label = "Command output" if verbose else "Command errors"
+        for line in process.stdout if verbose else process.stderr:
+            print(f"{label}: {line.rstrip()}")
+    # The output has already been streamed above, so nothing is held for this.
+    if process.returncode:
+        sys.exit(f"Command failed with exit code {process.returncode}")
 
-def get_extension(format):
-    return {"zip": ".zip", "tar": ".tar", "tgz": ".tgz", "tbz2": ".tbz2"}.get(
-        format, ""
+
+def set_output(name, value):
+    sys.stdout.flush()  # Keep log lines ahead of the output when both are stdout
+    # One O_APPEND write per output: atomic, unbuffered, and nothing left open.
+    fd = os.open(
+        os.getenv("GITHUB_OUTPUT") or "/dev/stdout",
+        os.O_WRONLY | os.O_APPEND | os.O_CREAT,
+        0o644,
     )
+    try:
+        os.write(fd, f"{name}={value}\n".encode())
+    finally:
+        os.close(fd)
+
+
+def get_extension(format):
+    return EXTENSIONS.get(format, "")
+
+
+def compress_program(program):
+    # tar splits the value itself, so the level can ride along as an argument.
+    return f"--use-compress-program={program} -{COMPRESS_LEVEL}"
+
+
+def exclude_archive(full_dest, root, target):
+    # Through a compress program tar cannot recognise its own output, so keep
+    # the archive out explicitly when it is written inside the archived tree.
+    rel = os.path.relpath(full_dest, os.path.join(root, target))
+    if rel == os.pardir or rel.startswith(os.pardir + os.sep):
+        return []
+    member = os.path.join(target, rel)
+    return ["--anchored", "--no-wildcards", f"--exclude={member}"]
+
+
+# zip and plain tar are handled in-process; tgz/tbz2 go through tar with the
+# multi-threaded pigz/pbzip2 from the action image. The thread count follows
+# the CPUs this process may actually run on.
+PARALLEL_THREADS = len(os.sched_getaffinity(0))
+PARALLEL_COMPRESSORS = {
+    "tgz": f"pigz --processes {PARALLEL_THREADS}",
+    "tbz2": f"pbzip2 -p{PARALLEL_THREADS}",
+}
+
+
+def parallel_tar_argv(program, full_dest, root, target):
+    return [
+        "tar",
+        compress_program(program),
+        *exclude_archive(full_dest, root, target),
+        *TAR_VERBOSE,
+        "-cf",
+        full_dest,
+        "-C",
+        root,
+        target,
+    ]
+
+
+def parallel_untar_argv(program, source, dest):
+    # tar adds -d itself when running the program to decompress.
+    return [
+        "tar",
+        f"--use-compress-program={program}",
+        *TAR_VERBOSE,
+        "-xf",
+        source,
+        "-C",
+        dest or ".",
+    ]
+
+
+# What zipfile/tarfile raise for unreadable sources or damaged archives.
+ARCHIVE_ERRORS = (OSError, tarfile.TarError, zipfile.BadZipFile, zlib.error)
+
+# tarfile copies member data 16 KiB at a time by default.
+COPY_BUFSIZE = 1024 * 1024
+
+
+class ZeroCopyTarFile(tarfile.TarFile):
+    # In an uncompressed archive on disk each member's bytes sit at a known
+    # offset, so copy them kernel-side instead of through Python buffers.
+    def makefile(self, tarinfo, targetpath):
+        if tarinfo.sparse is not None or not hasattr(os, "copy_file_range"):
+            return super().makefile(tarinfo, targetpath)
+        offset, remaining = tarinfo.offset_data, tarinfo.size
+        try:
+            with open(targetpath, "wb") as target:
+                while remaining:
+                    copied = os.copy_file_range(
+                        self.fileobj.fileno(), target.fileno(), remaining, offset
+                    )
+                    if not copied:
+                        raise tarfile.ReadError("unexpected end of data")
+                    offset += copied
+                    remaining -= copied
+        except OSError:
+            # Unsupported by this kernel or filesystem pair; copy normally.
+            super().makefile(tarinfo, targetpath)
+
+
+def open_tar(path, mode):
+    if mode == "r":
+        return ZeroCopyTarFile.open(path, "r:")
+    return tarfile.open(path, "w:", copybufsize=COPY_BUFSIZE)
+
+
+def write_zip(full_dest, path, arcname, verbose=VERBOSE):
+    archive_path = os.path.abspath(full_dest)
+    with zipfile.ZipFile(
+        full_dest, "w", zipfile.ZIP_DEFLATED, compresslevel=COMPRESS_LEVEL
+    ) as archive:
+        if not os.path.isdir(path):
+            archive.write(path, arcname)
+            return
+        # Follow symlinks like `zip -r` does, storing the target's contents.
+        for dirpath, dirnames, filenames in os.walk(path, followlinks=True):
+            dir_arcname = os.path.join(arcname, os.path.relpath(dirpath, path))
+            if os.path.normpath(dir_arcname) != ".":
+                archive.write(dirpath, dir_arcname)
+            for name in filenames:
+                file_path = os.path.join(dirpath, name)
+                if os.path.abspath(file_path) == archive_path:
+                    continue  # Never add the archive being written to itself
+                if verbose:
+                    print(file_path)
+                try:
+                    archive.write(file_path, os.path.join(dir_arcname, name))
+                except FileNotFoundError:
+                    print(f"Skipping missing file: {file_path}")
+
+
+def write_tar(full_dest, path, arcname, verbose=VERBOSE):
+    archive_path = os.path.abspath(full_dest)
+
+    def skip_archive(tarinfo):
+        member_path = os.path.join(path, os.path.relpath(tarinfo.name, arcname))
+        if os.path.abspath(member_path) == archive_path:
+            return None  # Never add the archive being written to itself
+        if verbose:
+            print(tarinfo.name)
+        return tarinfo
+
+    with open_tar(full_dest, "w") as archive:
+        archive.add(path, arcname, filter=skip_archive)
+
+
+def zip_member_path(dest, filename):
+    # Where ZipFile.extract puts a member: "", "." and ".." components dropped.
+    parts = [part for part in filename.split("/") if part not in ("", ".", "..")]
+    return os.path.join(dest or ".", *parts)
+
+
+def extract_zip_link(archive, info, dest):
+    # Recreate a stored symlink (`zip -y`) as unzip does; ZipFile.extract would
+    # write the target as a regular file, or through an existing link.
+    path = zip_member_path(dest, info.filename)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with suppress(FileNotFoundError):
+        os.remove(path)
+    os.symlink(archive.read(info).decode(), path)
+    return path
+
+
+def extract_zip_members(source, dest, members, verbose):
+    extracted = []
+    with zipfile.ZipFile(source) as archive:
+        for info in members:
+            if verbose:
+                print(info.filename)
+            if stat.S_ISLNK(info.external_attr >> 16):
+                extracted.append((extract_zip_link(archive, info, dest), info))
+                continue
+            try:
+                path = archive.extract(info, dest or ".")
+            except FileExistsError:
+                # Another worker created the same parent directory first.
+                path = archive.extract(info, dest or ".")
+            extracted.append((path, info))
+    return extracted
+
+
+def extract_zip(source, dest, verbose=VERBOSE):
+    with zipfile.ZipFile(source) as archive:
+        members = archive.infolist()
+    if not dest:
+        # Match `unzip -j -d .`: flatten every file into the cwd.
+        members = [info for info in members if not info.is_dir()]
+        for info in members:
+            info.filename = os.path.basename(info.filename)
+
+    # zlib releases the GIL while inflating, so members are extracted on
+    # several threads, each with its own ZipFile (a shared one serialises reads
+    # on its lock). Members with the same target stay on one worker, in order.
+    workers = max(1, min(PARALLEL_THREADS, len(members)))
+    batches = [[] for _ in range(workers)]
+    for info in members:
+        batches[hash(info.filename) % workers].append(info)
+    with ThreadPoolExecutor(workers) as pool:
+        results = pool.map(
+            lambda batch: extract_zip_members(source, dest, batch, verbose), batches
+        )
+        extracted = [item for result in results for item in result]
+
+    # zipfile restores neither permissions nor timestamps; do it as unzip does,
+    # without setuid/setgid/sticky (unzip needs -K for those). Directories go
+    # last so a read-only directory cannot block files extracted into it, and
+    # so extracting into a directory cannot bump its restored mtime.
+    for path, info in sorted(extracted, key=lambda item: item[1].is_dir()):
+        mode = info.external_attr >> 16
+        if not stat.S_ISLNK(mode) and mode & 0o777:
+            os.chmod(path, mode & 0o777)
+        mtime = time.mktime(info.date_time + (0, 0, -1))  # Stored as local time
+        os.utime(path, (mtime, mtime), follow_symlinks=False)
+
+
+def extract_tar(source, dest, verbose=VERBOSE):
+    def list_member(member, path):
+        if verbose:
+            print(member.name)
+        # Refuse absolute or escaping paths like GNU tar without -P, but keep
+        # the stored mode: as root GNU tar (used for tgz/tbz2) restores it all.
+        return tarfile.tar_filter(member, path).replace(mode=member.mode, deep=False)
+
+    with open_tar(source, "r") as archive:
+        archive.extractall(dest or ".", filter=list_member)
 
 
 def adjust_path(path):
-    adjusted_path = (
-        path
-        if os.path.isabs(path)
-        else os.path.join(os.getenv("GITHUB_WORKSPACE", os.getcwd()), path)
-    )
+    adjusted_path = path if os.path.isabs(path) else os.path.join(WORKSPACE, path)
     print(f"Adjusted path: {adjusted_path}")
     return adjusted_path
 
 
-def compress(source, format, include_root):
-    source = adjust_path(source)
-    cwd = os.getcwd()  # Save current directory
-    print(f"Initial CWD: {cwd}")  # Debug: Show initial working directory
+def make_dest(path):
+    try:
+        os.makedirs(path, exist_ok=True)
+    except OSError as error:
+        sys.exit(f"Cannot create destination {path}: {error}")
 
-    dest = os.getenv("DEST", os.getenv("GITHUB_WORKSPACE", os.getcwd()))
-    if dest and not os.path.exists(dest):
-        os.makedirs(dest)
 
+def compress(source, format, include_root, dest):
+    source = adjust_path(source)
+    if not os.path.exists(source):
+        sys.exit(f"Source not found: {source}")
     base_name = os.path.basename(source)
-    extension = get_extension(format)
-    full_dest = os.path.join(dest, f"{base_name}{extension}")
-    print(f"Destination Path: {full_dest}")  # Debug: Show full destination path
+    archive_name = f"{base_name}{get_extension(format)}"
 
     if os.path.isdir(source):
         # Compress a directory with the option of including root
-        print(f"Attempting to compress directory {source} to {full_dest}")
         if include_root == "true":
-            compress_target = base_name
-            os.chdir(os.path.dirname(source))  # Change to directory of the source
+            root, compress_target = os.path.dirname(source), base_name
         else:
-            compress_target = "."
-            os.chdir(
-                source
-            )  # Change to the source directory itself to compress its contents
-        print(
-            f"Changed CWD for Compression: {os.getcwd()}"
-        )  # Debug: Show CWD for compression
+            root, compress_target = source, "."
+        # A relative dest is relative to the directory being archived from.
+        full_dest = os.path.join(root, dest, archive_name)
+        print(f"Attempting to compress directory {source} to {full_dest}")
     else:
         # Compress a file - include_root has no effect here
+        root, compress_target = os.path.dirname(source), base_name
+        full_dest = os.path.abspath(os.path.join(dest, archive_name))
         print(f"Attempting to compress file {source} to {full_dest}")
-        compress_target = base_name
-        # os.chdir(os.path.dirname(source))  # Change to directory of the source
-
-    if format == "zip":
-        run_command(f"zip -r {full_dest} {compress_target}")
-    elif format == "tar":
-        run_command(f"tar --absolute-names -cvf {full_dest} {compress_target}")
-    elif format == "tgz":
-        run_command(f"tar -P -czvf {full_dest} {compress_target}")
-    elif format == "tbz2":
-        run_command(f"tar -P -cjvf {full_dest} {compress_target}")
+    print(f"Archiving {compress_target} from {root}")
+
+    if dest:
+        make_dest(os.path.dirname(full_dest))
+
+    # Everything below works from absolute paths; the process cwd never moves.
+    path = os.path.normpath(os.path.join(root, compress_target))
+    parallel_compressor = PARALLEL_COMPRESSORS.get(format)
+    if parallel_compressor:
+        run_command(
+            parallel_tar_argv(parallel_compressor, full_dest, root, compress_target)
+        )
     else:
-        sys.exit(f"Unsupported format: {format}")
-    os.chdir(cwd)  # Restore original working directory.
-    print(f"Restored CWD: {os.getcwd()}")  # Debug: Show restored working directory
-    print(
-        f"file_path={full_dest}",
-        file=open(os.getenv("GITHUB_OUTPUT", "/dev/stdout"), "a"),
-    )
+        print(f"Writing {format} archive in-process")
+        try:
+            if format == "zip":
+                write_zip(full_dest, path, compress_target)
+            else:
+                write_tar(full_dest, path, compress_target)
+        except ARCHIVE_ERRORS as error:
+            with suppress(OSError):
+                os.remove(full_dest)  # Don't leave a partial archive behind
+            sys.exit(f"Failed to create {full_dest}: {error}")
+    # full_dest is a container path; report the archive as the inputs name it.
+    set_output("file_path", os.path.join(dest, archive_name))
 
 
-def decompress(source, format):
+def decompress(source, format, dest):
     source = adjust_path(source)
-    dest = os.getenv("DEST", os.getenv("GITHUB_WORKSPACE", os.getcwd()))
-    if dest and not os.path.exists(dest):
-        os.makedirs(dest)
+    if not os.path.isfile(source):
+        sys.exit(f"Source not found: {source}")
+    if dest:
+        make_dest(dest)
 
     print(
         f"Attempting to decompress {source} to {dest if dest else 'current directory'}"
     )
 
-    if format == "zip":
-        unzip_options = f"-d {dest}" if dest else "-j -d ."
-        run_command(f"unzip {unzip_options} {source}")
-    elif format == "tar":
-        tar_options = f"-C {dest}" if dest else "-C ."
-        run_command(f"tar --absolute-names -xvf {source} {tar_options}")
-    elif format == "tgz":
-        tar_options = f"-C {dest}" if dest else "-C ."
-        run_command(f"tar -P -xzvf {source} {tar_options}")
-    elif format == "tbz2":
-        tar_options = f"-C {dest}" if dest else "-C ."
-        run_command(f"tar -P -xjvf {source} {tar_options}")
+    parallel_compressor = PARALLEL_COMPRESSORS.get(format)
+    if parallel_compressor:
+        run_command(parallel_untar_argv(parallel_compressor, source, dest))
     else:
-        sys.exit(f"Unsupported format: {format}")
+        print(f"Extracting {format} archive in-process")
+        try:
+            if format == "zip":
+                extract_zip(source, dest)
+            else:
+                extract_tar(source, dest)
+        except ARCHIVE_ERRORS as error:
+            sys.exit(f"Failed to extract {source}: {error}")
 
-    print(
-        f"file_path={dest if dest else 'current directory'}",
-        file=open(os.getenv("GITHUB_OUTPUT", "/dev/stdout"), "a"),
-    )
+    set_output("file_path", dest if dest else "current directory")
 
 
 if __name__ == "__main__":
-    command = os.getenv("COMMAND")
-    source = os.getenv("SOURCE")
-    format = os.getenv("FORMAT")
-    include_root = os.getenv("INCLUDEROOT", "true")
+    # Read every input once here and pass it down, rather than having each
+    # step go back to the environment.
+    env = os.environ
+    command = env.get("COMMAND")
+    source = env.get("SOURCE")
+    format = env.get("FORMAT")
+    include_root = env.get("INCLUDEROOT", "true")
+    dest = env.get("DEST", WORKSPACE)
+    if format not in SUPPORTED_FORMAT_SET:
+        sys.exit(
+            f"Unsupported format: {format}. "
+            f"Supported formats: {', '.join(SUPPORTED_FORMATS)}"
+        )
+    if command == "compress" and COMPRESS_LEVEL not in range(1, 10):
+        sys.exit(f"Unsupported compression level: {COMPRESS_LEVEL_INPUT}. Use 1-9.")
     if command == "compress":
-        compress(source, format, include_root)
+        compress(source, format, include_root, dest)
     elif command == "decompress":
-        decompress(source, format)
+        decompress(source, format, dest)